@@ -1,5 +1,6 @@
 import asyncio
-import json
+import asyncio.subprocess
+import enum
 import os
 import subprocess
 import sys
@@ -8,6 +9,137 @@ import typing
 import re
 from pydantic import BaseModel, Field
 
+_BLOCK_RE = re.compile(r"```(.*?)```", re.DOTALL)
+_INLINE_TAG_RE = re.compile(r"(python3?|bash|shell|sh)\s+")
+_PY_HEURISTIC = re.compile(r"import |print[( ]")
+_BASH_HEURISTIC = re.compile(r"echo |if \[|; do|esac\n")
+_INTERPRETERS = {"bash": "/bin/bash", "python": sys.executable}
+# How often partial stdout is pushed to the UI while code is still running.
+_PROGRESS_INTERVAL_SECONDS = 0.5
+# Below this address space limit interpreters fail to even start, often with
+# no error output at all.
+_MIN_MEMORY_BYTES = 64 << 20
+
+
+# Open WebUI installs each tool and function as a single standalone file, so
+# this module cannot import shared code. The helpers below through
+# _run_interpreter, and EmitMode through CodeExecutionTracker, are kept
+# identical to their copies in UnsafeCodeExecutionTool.py; change both together.
+def _open_script(code, tmp_dir):
+    """
+    Write code to an in-memory file the interpreter can read it back from.
+    Returns the path to pass to the interpreter and the file descriptor to
+    hand down to it; the caller closes the descriptor once spawned.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("code", 0)
+        path = f"/proc/self/fd/{fd}"
+    else:
+        path = os.path.join(tmp_dir, "code")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with open(fd, "wb", closefd=False) as f:
+            f.write((code + "\n").encode())
+    except BaseException:
+        os.close(fd)
+        raise
+    return path, fd
+
+
+class _TimeoutWithOutput(asyncio.TimeoutError):
+    """
+    Raised when code outlives MAX_RUNTIME_SECONDS, carrying the stdout and
+    stderr it produced before it was killed.
+    """
+
+    def __init__(self, stdout, stderr):
+        super().__init__()
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+async def _read_capped(reader, buf, cap, on_progress=None):
+    """
+    Read a stream to EOF into `buf`, keeping at most `cap` bytes of it.
+    Draining the remainder keeps the child from blocking on a full pipe.
+    `buf` holds what was read so far even if this is cancelled.
+    If given, `on_progress` is awaited with the bytes kept so far whenever
+    more have arrived, at most once every _PROGRESS_INTERVAL_SECONDS.
+    """
+    loop = asyncio.get_running_loop()
+    next_progress = loop.time() + _PROGRESS_INTERVAL_SECONDS
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        if len(buf) < cap:
+            buf.extend(chunk[: cap - len(buf)])
+            if on_progress is not None and loop.time() >= next_progress:
+                await on_progress(buf)
+                next_progress = loop.time() + _PROGRESS_INTERVAL_SECONDS
+
+
+def _memory_limited(max_memory_bytes, *argv):
+    """
+    Wrap a command so it runs with its address space capped, or leave it as
+    is if `max_memory_bytes` is 0.
+    The limit is applied by a `ulimit` shim rather than a preexec_fn, so that
+    subprocess can keep spawning via vfork instead of a full fork of this
+    (potentially large) server process.
+    """
+    if max_memory_bytes == 0:
+        return argv
+    if max_memory_bytes < _MIN_MEMORY_BYTES:
+        raise ValueError(
+            f"MAX_MEMORY_BYTES must be 0 (no limit) or at least {_MIN_MEMORY_BYTES}, "
+            f"got {max_memory_bytes}"
+        )
+    return (
+        "/bin/bash",
+        "-c",
+        'ulimit -v "$0" && exec "$@"',
+        str(max_memory_bytes // 1024),
+        *argv,
+    )
+
+
+async def _run_interpreter(interpreter_path, code, cwd, valves, on_stdout=None):
+    """
+    Run code in a fresh interpreter process.
+    Returns (returncode, stdout, stderr); raises _TimeoutWithOutput after
+    killing the process if it outlives MAX_RUNTIME_SECONDS. `on_stdout` is
+    awaited with partial stdout while the process runs.
+    """
+    script_path, script_fd = _open_script(code, cwd)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *_memory_limited(valves.MAX_MEMORY_BYTES, interpreter_path, script_path),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            pass_fds=(script_fd,),
+        )
+    finally:
+        os.close(script_fd)
+    stdout = bytearray()
+    stderr = bytearray()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                _read_capped(proc.stdout, stdout, valves.MAX_OUTPUT_BYTES, on_stdout),
+                _read_capped(proc.stderr, stderr, valves.MAX_OUTPUT_BYTES),
+                proc.wait(),
+            ),
+            timeout=valves.MAX_RUNTIME_SECONDS,
+        )
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise _TimeoutWithOutput(stdout, stderr) from None
+    return proc.returncode, stdout, stderr
+
+
 class Action:
     class Valves(BaseModel):
         MAX_RUNTIME_SECONDS: int = Field(
@@ -16,6 +148,14 @@ class Action:
         DEBUG: bool = Field(
             default=False, description="Whether to produce debug logs during execution."
         )
+        MAX_OUTPUT_BYTES: int = Field(
+            default=1 << 20,
+            description="Maximum number of bytes kept from each of stdout and stderr; the rest is discarded.",
+        )
+        MAX_MEMORY_BYTES: int = Field(
+            default=2 << 30,
+            description=f"Maximum address space the code may use, in bytes; 0 disables the limit. Must otherwise be at least {_MIN_MEMORY_BYTES}.",
+        )
     def __init__(self):
         self.valves = self.Valves()
 
@@ -45,24 +185,38 @@ class Action:
             return await _fail(
                 "Last message was not from the AI model.", status="INVALID_INPUT"
             )
-        split_three_backticks = last_message["content"].split("```")
-        if len(split_three_backticks) < 3 or len(split_three_backticks) % 2 != 1:
+        content = last_message["content"]
+        code_blocks = []
+        for match in _BLOCK_RE.finditer(content):
+            # The info string ("python", "python title=a.py", "c++ ") runs up
+            # to the first newline. A block with no newline only has a tag if
+            # it starts with a known language, as in "```python print(1)```".
+            info, newline, code_block = match.group(1).partition("\n")
+            if not newline:
+                inline_tag = _INLINE_TAG_RE.match(info)
+                if inline_tag:
+                    info, code_block = inline_tag.group(1), info[inline_tag.end() :]
+                else:
+                    info, code_block = "", info
+            info = info.split()
+            code_blocks.append((info[0] if info else None, code_block))
+        if not code_blocks or content.count("```") % 2 != 0:
             return await _fail(
                 "Last message did not contain well-formed code blocks.",
                 status="INVALID_INPUT",
             )
         chosen_code_block = None
         language = None
-        for code_block in split_three_backticks[-2:0:-2]:
-            if code_block.startswith("python\n") or code_block.startswith("python3\n"):
+        for block_language, code_block in reversed(code_blocks):
+            if block_language in ("python", "python3"):
                 chosen_code_block = code_block
                 language = "python"
-            elif code_block.startswith("bash\n") or code_block.startswith("sh\n") or code_block.startswith("shell\n"):
+            elif block_language in ("bash", "sh", "shell"):
                 chosen_code_block = code_block
                 language = "bash"
                 break
         if not chosen_code_block:
-            last_code_block = split_three_backticks[-2]
+            last_code_block = code_blocks[-1][1]
             first_line = last_code_block.strip().split("\n")[0]
             if first_line.startswith("#!") and (
                 first_line.endswith("python") or first_line.endswith("python3")
@@ -72,16 +226,10 @@ class Action:
             elif first_line.startswith("#!") and first_line.endswith("sh"):
                 chosen_code_block = last_code_block
                 language = "bash"
-            elif any(
-                python_like in last_code_block
-                for python_like in ("import ", "print(", "print ")
-            ):
+            elif _PY_HEURISTIC.search(last_code_block):
                 chosen_code_block = last_code_block
                 language = "python"
-            elif any(
-                bash_like in last_code_block
-                for bash_like in ("echo ", "if [", "; do", "esac\n")
-            ):
+            elif _BASH_HEURISTIC.search(last_code_block):
                 chosen_code_block = last_code_block
                 language = "bash"
         if not chosen_code_block:
@@ -90,45 +238,44 @@ class Action:
             )
 
         try:
-            code = chosen_code_block
-            if language == "python":
-                code = code.removeprefix("python3").removeprefix("python")
-            elif language == "bash":
-                code = code.removeprefix("shell").removeprefix("bash").removeprefix("sh")
-            code = code.strip()
+            code = chosen_code_block.strip()
             language_title = language.title()
             execution_tracker = CodeExecutionTracker(
                 name=f"{language_title} code block", code=code, language=language
             )
             await emitter.clear_status()
             await emitter.code_execution(execution_tracker)
+            # The child runs with this private directory as its working directory so
+            # files it writes are cleaned up with the run. This is not isolation:
+            # absolute paths still reach the host filesystem. Confining it further
+            # would take a chroot or mount namespace (e.g. `unshare --mount`).
             with tempfile.TemporaryDirectory(prefix="code_exec_") as tmp_dir:
                 output = None
                 status = "UNKNOWN"
                 try:
-                   interpreter_path = None
-                   if language == "bash":
-                       interpreter_path = "/bin/bash"
-                   elif language == "python":
-                        interpreter_path = sys.executable
+                   interpreter_path = _INTERPRETERS.get(language)
                    if not interpreter_path:
                        raise RuntimeError(f"Cannot find interpreter for language: {language}")
-                   result = subprocess.run(
-                        [interpreter_path, "/dev/stdin"],
-                        input=code + "\n",
-                        text=True,
-                        capture_output=True,
-                        timeout=valves.MAX_RUNTIME_SECONDS,
-                        check=False,
+
+                   async def _on_stdout(data):
+                       execution_tracker.set_output(data.decode(errors="replace"))
+                       await emitter.code_execution(execution_tracker)
+
+                   returncode, stdout, stderr = await _run_interpreter(
+                        interpreter_path,
+                        code,
+                        cwd=tmp_dir,
+                        valves=valves,
+                        on_stdout=_on_stdout,
                     )
-                   if result.returncode != 0:
+                   if returncode != 0:
                       status="ERROR"
-                      output=result.stderr
-                      raise subprocess.CalledProcessError(returncode=result.returncode, cmd=[interpreter_path, "/dev/stdin"], stderr=result.stderr, output=result.stdout)
+                      output=stderr.decode(errors="replace")
+                      raise subprocess.CalledProcessError(returncode=returncode, cmd=[interpreter_path], stderr=output, output=stdout.decode(errors="replace"))
                    else:
                        status="OK"
-                       output=result.stdout
-                except subprocess.TimeoutExpired as e:
+                       output=stdout.decode(errors="replace")
+                except asyncio.TimeoutError as e:
                     await emitter.fail(
                         f"Code timed out after {valves.MAX_RUNTIME_SECONDS} seconds"
                     )
@@ -136,7 +283,13 @@ class Action:
                         f"Code timed out after {valves.MAX_RUNTIME_SECONDS} seconds"
                     )
                     status = "TIMEOUT"
-                    output = e.stderr
+                    # Keep the stdout already streamed to the citation as well
+                    # as any error output, rather than blanking it.
+                    output = "\n".join(
+                        part.decode(errors="replace").strip()
+                        for part in (e.stdout, e.stderr)
+                        if part.strip()
+                    )
                 except subprocess.CalledProcessError as e:
                     await emitter.fail(f"{language_title}: {e}")
                     execution_tracker.set_error(f"{language_title}: {e}")
@@ -186,43 +339,69 @@ class Action:
             return await _fail(f"Unhandled exception: {e}")
 
 
+class EmitMode(enum.Enum):
+    ONCE = "once"
+    # Some front-ends drop the first event of a kind, so it is sent again on
+    # the next loop iteration without holding up the caller. The copy is
+    # always delivered before the emitter's next event.
+    DEFERRED_SECOND = "deferred_second"
+
+
 class EventEmitter:
     def __init__(
         self,
-        event_emitter: typing.Callable[[dict], typing.Any] = None,
+        event_emitter: typing.Any = None,
         debug: bool = False,
     ):
         self.event_emitter = event_emitter
         self._debug = debug
+        self._enabled = bool(event_emitter) or debug
         self._status_prefix = None
         self._emitted_status = False
+        self._duplicate = None
 
     def set_status_prefix(self, status_prefix):
         self._status_prefix = status_prefix
 
-    async def _emit(self, typ, data, twice):
+    async def _emit(self, typ, data, mode):
+        if not self._enabled:
+            return None
+        await self._flush_duplicate()
+        result = await self._send(typ, data)
+        if mode is EmitMode.DEFERRED_SECOND and self.event_emitter:
+            self._duplicate = asyncio.ensure_future(self._send(typ, data))
+        return result
+
+    async def _flush_duplicate(self):
+        # Deliver a still-pending copy of the previous event first so events
+        # keep their order, and so its errors reach a caller.
+        duplicate, self._duplicate = self._duplicate, None
+        if duplicate is not None:
+            await duplicate
+
+    async def _send(self, typ, data):
         if self._debug:
             print(f"Emitting {typ} event: {data}", file=sys.stderr)
         if not self.event_emitter:
             return None
-        result = None
-        for _ in range(2 if twice else 1):
-            maybe_future = self.event_emitter(
-                {
-                    "type": typ,
-                    "data": data,
-                }
-            )
-            if asyncio.isfuture(maybe_future) or isinstance(maybe_future, typing.Awaitable):
-                result = await maybe_future
-        return result
+        maybe_future = self.event_emitter(
+            {
+                "type": typ,
+                "data": data,
+            }
+        )
+        if maybe_future is not None and hasattr(maybe_future, "__await__"):
+            return await maybe_future
+        return None
 
     async def status(
         self, description="Unknown state", status="in_progress", done=False
     ):
+        if not self._enabled:
+            return
         self._emitted_status = True
         if self._status_prefix is not None:
-            description = f"{self._status_prefix}{description}"
+            description = self._status_prefix + description
         await self._emit(
             "status",
             {
@@ -230,7 +409,11 @@ class EventEmitter:
                 "description": description,
                 "done": done,
             },
-            twice=not done and len(description) <= 1024,
+            mode=(
+                EmitMode.DEFERRED_SECOND
+                if not done and len(description) <= 1024
+                else EmitMode.ONCE
+            ),
         )
 
     async def fail(self, description="Unknown error"):
@@ -247,20 +430,27 @@ class EventEmitter:
                 "description": "",
                 "done": True,
             },
-            twice=True,
+            mode=EmitMode.DEFERRED_SECOND,
         )
 
     async def message(self, content):
+        if not self._enabled:
+            return
         await self._emit(
             "message",
             {
                 "content": content,
             },
-            twice=False,
+            mode=EmitMode.ONCE,
         )
+
     async def code_execution(self, code_execution_tracker):
+        if not self._enabled:
+            return
         await self._emit(
-            "citation", code_execution_tracker._citation_data(), twice=True
+            "citation",
+            code_execution_tracker._citation_data(),
+            mode=EmitMode.ONCE,
         )
 
 
@@ -271,6 +461,13 @@ class CodeExecutionTracker:
         self.code = code
         self.language = language
         self._result = {}
+        self._base = {
+            "type": "code_execution",
+            "id": self._uuid,
+            "name": name,
+            "code": code,
+            "language": language,
+        }
 
     def set_error(self, error):
         self._result["error"] = error
@@ -278,18 +475,11 @@ class CodeExecutionTracker:
     def set_output(self, output):
         self._result["output"] = output
 
-
     def _citation_data(self):
-        data = {
-            "type": "code_execution",
-            "id": self._uuid,
-            "name": self.name,
-            "code": self.code,
-            "language": self.language,
-        }
-        if "output" in self._result or "error" in self._result:
-            data["result"] = self._result
-        return data
+        if self._result:
+            return {**self._base, "result": self._result}
+        return self._base
+
 
 # Debug utility: Run code from stdin if running as a normal Python script.
 if __name__ == "__main__":
@@ -329,4 +519,16 @@ if __name__ == "__main__":
         output_str = await action.action(body=body, __event_emitter__=_dummy_emitter)
         print(output_str)
 
-    asyncio.run(_local_run())
+    # Most awaits here (emitter events, status updates) complete without
+    # suspending, so eager task execution skips a trip through the scheduler.
+    # When hosted by Open WebUI, the same can be enabled at server startup with
+    # `asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)`
+    # on Python 3.12+.
+    loop = asyncio.new_event_loop()
+    if hasattr(asyncio, "eager_task_factory"):
+        loop.set_task_factory(asyncio.eager_task_factory)
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_local_run())
+    finally:
+        loop.close()
@@ -1,13 +1,399 @@
 import asyncio
+import asyncio.subprocess
+import contextlib
+import enum
 import json
 import os
-import subprocess
 import sys
 import tempfile
 import typing
 import re
 from pydantic import BaseModel, Field
 
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    _dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+_FENCE_RE = re.compile(
+    r"\A```(?:(?:python3?|bash|shell|sh)(?=\s|\Z))?[ \t]*\r?\n?|```\s*\Z"
+)
+_INTERPRETERS = {"bash": "/bin/bash", "python": sys.executable}
+_OK_TPL = "\n<details>\n<summary>Code Execution</summary>\nI executed the following {language} code:\n```{language}\n{code}\n```\n```Output\n{output}\n```\n</details>\n"
+_TIMEOUT_OUTPUT_TPL = "\n\n---\nI executed this {language_title} code and it timed out after {timeout} seconds:\n```Error\n{output}\n```\n"
+_TIMEOUT_TPL = "\n\n---\nI executed this {language_title} code and it timed out after {timeout} seconds.\n"
+_ERROR_OUTPUT_TPL = "\n\n---\nI executed this {language_title} code and got the following error:\n```Error\n{output}\n```\n"
+_ERROR_TPL = "\n\n---\nI executed this {language_title} code but got an unexplained error.\n"
+# How often partial stdout is pushed to the UI while code is still running.
+_PROGRESS_INTERVAL_SECONDS = 0.5
+# Below this address space limit interpreters fail to even start, often with
+# no error output at all.
+_MIN_MEMORY_BYTES = 64 << 20
+
+
+# Open WebUI installs each tool and function as a single standalone file, so
+# this module cannot import shared code. The helpers below through
+# _run_interpreter, and EmitMode through CodeExecutionTracker, are kept
+# identical to their copies in UnsafeCodeExecutionFunction.py; change both together.
+def _open_script(code, tmp_dir):
+    """
+    Write code to an in-memory file the interpreter can read it back from.
+    Returns the path to pass to the interpreter and the file descriptor to
+    hand down to it; the caller closes the descriptor once spawned.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("code", 0)
+        path = f"/proc/self/fd/{fd}"
+    else:
+        path = os.path.join(tmp_dir, "code")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with open(fd, "wb", closefd=False) as f:
+            f.write((code + "\n").encode())
+    except BaseException:
+        os.close(fd)
+        raise
+    return path, fd
+
+
+class _TimeoutWithOutput(asyncio.TimeoutError):
+    """
+    Raised when code outlives MAX_RUNTIME_SECONDS, carrying the stdout and
+    stderr it produced before it was killed.
+    """
+
+    def __init__(self, stdout, stderr):
+        super().__init__()
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+async def _read_capped(reader, buf, cap, on_progress=None):
+    """
+    Read a stream to EOF into `buf`, keeping at most `cap` bytes of it.
+    Draining the remainder keeps the child from blocking on a full pipe.
+    `buf` holds what was read so far even if this is cancelled.
+    If given, `on_progress` is awaited with the bytes kept so far whenever
+    more have arrived, at most once every _PROGRESS_INTERVAL_SECONDS.
+    """
+    loop = asyncio.get_running_loop()
+    next_progress = loop.time() + _PROGRESS_INTERVAL_SECONDS
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        if len(buf) < cap:
+            buf.extend(chunk[: cap - len(buf)])
+            if on_progress is not None and loop.time() >= next_progress:
+                await on_progress(buf)
+                next_progress = loop.time() + _PROGRESS_INTERVAL_SECONDS
+
+
+def _memory_limited(max_memory_bytes, *argv):
+    """
+    Wrap a command so it runs with its address space capped, or leave it as
+    is if `max_memory_bytes` is 0.
+    The limit is applied by a `ulimit` shim rather than a preexec_fn, so that
+    subprocess can keep spawning via vfork instead of a full fork of this
+    (potentially large) server process.
+    """
+    if max_memory_bytes == 0:
+        return argv
+    if max_memory_bytes < _MIN_MEMORY_BYTES:
+        raise ValueError(
+            f"MAX_MEMORY_BYTES must be 0 (no limit) or at least {_MIN_MEMORY_BYTES}, "
+            f"got {max_memory_bytes}"
+        )
+    return (
+        "/bin/bash",
+        "-c",
+        'ulimit -v "$0" && exec "$@"',
+        str(max_memory_bytes // 1024),
+        *argv,
+    )
+
+
+async def _run_interpreter(interpreter_path, code, cwd, valves, on_stdout=None):
+    """
+    Run code in a fresh interpreter process.
+    Returns (returncode, stdout, stderr); raises _TimeoutWithOutput after
+    killing the process if it outlives MAX_RUNTIME_SECONDS. `on_stdout` is
+    awaited with partial stdout while the process runs.
+    """
+    script_path, script_fd = _open_script(code, cwd)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *_memory_limited(valves.MAX_MEMORY_BYTES, interpreter_path, script_path),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            pass_fds=(script_fd,),
+        )
+    finally:
+        os.close(script_fd)
+    stdout = bytearray()
+    stderr = bytearray()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                _read_capped(proc.stdout, stdout, valves.MAX_OUTPUT_BYTES, on_stdout),
+                _read_capped(proc.stderr, stderr, valves.MAX_OUTPUT_BYTES),
+                proc.wait(),
+            ),
+            timeout=valves.MAX_RUNTIME_SECONDS,
+        )
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise _TimeoutWithOutput(stdout, stderr) from None
+    return proc.returncode, stdout, stderr
+
+
+# Runs inside each pooled Python worker. Requests arrive on stdin as a
+# length-prefixed working directory followed by length-prefixed code; each
+# response is the exit status and whether the worker may be reused, followed by
+# length-prefixed stdout and stderr.
+# File descriptors 1 and 2 are pointed at pipes during a run so that output
+# from child processes the code starts is captured too. Threads drain the
+# pipes, keeping at most `cap` bytes of each and dropping the rest.
+_PYTHON_WORKER_SOURCE = r"""
+import linecache
+import os
+import sys
+import threading
+import traceback
+
+# Left as a fresh `python -c` would see it; the cap is not the code's business.
+cap = int(sys.argv.pop(1))
+argv = list(sys.argv)
+streams = (sys.stdin, sys.stdout, sys.stderr)
+requests = os.fdopen(os.dup(0), "rb")
+responses = os.fdopen(os.dup(1), "wb")
+devnull = os.open(os.devnull, os.O_RDWR)
+for fd in (0, 1, 2):
+    os.dup2(devnull, fd)
+home = os.getcwd()
+
+
+def read_frame():
+    header = requests.read(4)
+    if len(header) < 4:
+        return None
+    return requests.read(int.from_bytes(header, "big"))
+
+
+def frame(data):
+    return len(data).to_bytes(4, "big") + data
+
+
+def drain(fd, buf):
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        if len(buf) < cap:
+            buf.extend(chunk[: cap - len(buf)])
+    os.close(fd)
+
+
+def capture(target):
+    read_fd, write_fd = os.pipe()
+    os.dup2(write_fd, target)
+    os.close(write_fd)
+    buf = bytearray()
+    thread = threading.Thread(target=drain, args=(read_fd, buf), daemon=True)
+    thread.start()
+    return thread, buf
+
+
+while True:
+    cwd = read_frame()
+    code = read_frame()
+    if cwd is None or code is None:
+        break
+    out_thread, out = capture(1)
+    err_thread, err = capture(2)
+    returncode = 0
+    message = None
+    lines = code.decode(errors="replace").splitlines(True)
+    linecache.cache["<code>"] = (len(code), None, lines, "<code>")
+    sys.argv = list(argv)
+    try:
+        os.chdir(cwd)
+        exec(compile(code, "<code>", "exec"), {"__name__": "__main__"})
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code & 0xFF
+        else:
+            message = f"{e.code}\n"
+            returncode = 1
+    except BaseException as e:
+        # Drop this loop's own frame so the traceback starts at the code.
+        message = "".join(
+            traceback.format_exception(type(e), e, e.__traceback__.tb_next)
+        )
+        returncode = 1
+    # The code may have replaced, or closed, the standard streams.
+    for stream in (sys.stdout, sys.stderr, *streams[1:]):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+    sys.stdin, sys.stdout, sys.stderr = streams
+    sys.argv = list(argv)
+    if message is not None:
+        # Written to the descriptor directly in case sys.stderr is closed.
+        os.write(2, message.encode(errors="replace"))
+    # Closing the write ends lets the drain threads see EOF once any child
+    # processes the code started have exited too.
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.chdir(home)
+    out_thread.join()
+    err_thread.join()
+    # Threads the code left running, or streams it closed, would leak into
+    # later runs, so the worker asks to be replaced instead.
+    reusable = threading.active_count() == 1 and not any(
+        stream.closed for stream in streams
+    )
+    responses.write(bytes([returncode, reusable]) + frame(out) + frame(err))
+    responses.flush()
+"""
+
+# Pooled workers are replaced after this many runs to bound state leaking
+# from one run into the next.
+_PYTHON_WORKER_MAX_RUNS = 100
+
+
+class _NoPythonWorkerAvailable(Exception):
+    """
+    Raised when every pooled Python worker stays busy for the whole timeout.
+    """
+
+
+class _PythonWorkerPool:
+    """
+    A fixed number of long-lived Python interpreters, started on first use,
+    that run code sent to them instead of paying interpreter startup per call.
+    """
+
+    def __init__(self, size, max_memory_bytes, max_output_bytes):
+        self._size = size
+        self._max_memory_bytes = max_memory_bytes
+        self._max_output_bytes = max_output_bytes
+        self._idle = asyncio.Queue()
+        # Workers that are idle, busy or being spawned. Kept separately from
+        # the queue so a failed spawn is retried instead of losing a slot.
+        self._workers = 0
+        self._closed = False
+
+    @property
+    def config(self):
+        return self._size, self._max_memory_bytes, self._max_output_bytes
+
+    async def close(self):
+        """
+        Stop idle workers now, and busy ones once their current run ends.
+        """
+        self._closed = True
+        while not self._idle.empty():
+            proc, _ = self._idle.get_nowait()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+    async def _spawn(self):
+        return await asyncio.create_subprocess_exec(
+            *_memory_limited(
+                self._max_memory_bytes,
+                sys.executable,
+                "-c",
+                _PYTHON_WORKER_SOURCE,
+                str(self._max_output_bytes),
+            ),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+
+    async def _read_frame(self, reader):
+        size = int.from_bytes(await reader.readexactly(4), "big")
+        return await reader.readexactly(size)
+
+    async def _exchange(self, proc, code, cwd):
+        for data in (cwd.encode(), code.encode()):
+            proc.stdin.write(len(data).to_bytes(4, "big") + data)
+        await proc.stdin.drain()
+        returncode, reusable = await proc.stdout.readexactly(2)
+        stdout = await self._read_frame(proc.stdout)
+        stderr = await self._read_frame(proc.stdout)
+        return (returncode, stdout, stderr), bool(reusable)
+
+    async def _fill(self):
+        while self._workers < self._size:
+            self._workers += 1
+            try:
+                proc = await self._spawn()
+            except BaseException:
+                self._workers -= 1
+                raise
+            self._idle.put_nowait((proc, 0))
+
+    async def run(self, code, cwd, timeout):
+        """
+        Run code in an idle worker.
+        Returns (returncode, stdout, stderr) like a fresh interpreter would.
+        Waiting for a worker and running the code share `timeout` seconds:
+        raises _NoPythonWorkerAvailable if no worker frees up in time, and
+        _TimeoutWithOutput, without any output, if the code does not finish.
+        """
+        deadline = asyncio.get_running_loop().time() + timeout
+        try:
+            await self._fill()
+        except OSError:
+            # Run on the workers that did start, if any.
+            if not self._workers:
+                raise
+        try:
+            proc, runs = await asyncio.wait_for(self._idle.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise _NoPythonWorkerAvailable(
+                f"No Python worker became available within {timeout} seconds"
+            ) from None
+        reusable = False
+        try:
+            result, reusable = await asyncio.wait_for(
+                self._exchange(proc, code, cwd),
+                timeout=deadline - asyncio.get_running_loop().time(),
+            )
+            return result
+        except asyncio.TimeoutError:
+            raise _TimeoutWithOutput(b"", b"") from None
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The code took the worker down with it, e.g. via os._exit(), or
+            # the worker could not start, e.g. under a tight memory limit.
+            return await proc.wait(), b"", b""
+        finally:
+            if reusable and runs + 1 < _PYTHON_WORKER_MAX_RUNS and not self._closed:
+                self._idle.put_nowait((proc, runs + 1))
+            else:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                self._workers -= 1
+                # A replacement that fails to start now is retried by the
+                # next run's _fill().
+                if not self._closed:
+                    with contextlib.suppress(OSError):
+                        await self._fill()
+
 
 class Tools:
     class Valves(BaseModel):
@@ -17,9 +403,27 @@ class Tools:
         DEBUG: bool = Field(
             default=False, description="Whether to produce debug logs during execution."
         )
+        MAX_OUTPUT_BYTES: int = Field(
+            default=1 << 20,
+            description="Maximum number of bytes kept from each of stdout and stderr; the rest is discarded.",
+        )
+        MAX_MEMORY_BYTES: int = Field(
+            default=2 << 30,
+            description=f"Maximum address space the code may use, in bytes; 0 disables the limit. Must otherwise be at least {_MIN_MEMORY_BYTES}.",
+        )
+        PYTHON_WORKERS: int = Field(
+            default=0,
+            description=(
+                "Number of long-lived Python interpreters to run Python code in, "
+                "avoiding interpreter startup on every call. Workers share state "
+                "between runs until recycled. 0 starts a fresh interpreter for each "
+                "run."
+            ),
+        )
 
     def __init__(self):
         self.valves = self.Valves()
+        self._python_workers = None
 
     async def run_bash_command(
         self,
@@ -34,13 +438,12 @@ class Tools:
             code=bash_command,
             event_emitter=__event_emitter__,
         )
-        return json.dumps(
+        return _dumps(
             {
                 "bash_command": bash_command,
                 "status": result["status"],
                 "output": result["output"],
-            },
-            ensure_ascii=False,
+            }
         )
 
     async def run_python_code(
@@ -56,15 +459,33 @@ class Tools:
             code=python_code,
             event_emitter=__event_emitter__,
         )
-        return json.dumps(
+        return _dumps(
             {
                 "python_code": python_code,
                 "status": result["status"],
                 "output": result["output"],
-            },
-            ensure_ascii=False,
+            }
         )
 
+    async def _get_python_workers(self):
+        """
+        Return the Python worker pool matching the current valves, replacing
+        the existing one if they changed, or None if pooling is disabled.
+        """
+        valves = self.valves
+        config = (
+            valves.PYTHON_WORKERS,
+            valves.MAX_MEMORY_BYTES,
+            valves.MAX_OUTPUT_BYTES,
+        )
+        pool = self._python_workers
+        if pool is not None and pool.config != config:
+            self._python_workers = None
+            await pool.close()
+        if valves.PYTHON_WORKERS > 0 and self._python_workers is None:
+            self._python_workers = _PythonWorkerPool(*config)
+        return self._python_workers
+
     async def _run_code(
         self,
         language: str,
@@ -96,10 +517,7 @@ class Tools:
             output = None
             language_title = language.title()
 
-            code = code.strip()
-            code = code.removeprefix("```" + language).removeprefix("```").removesuffix("```")
-            code = code.strip()
-            code = code.strip("`").strip()
+            code = _FENCE_RE.sub("", code.strip()).strip("`").strip()
 
             execution_tracker = CodeExecutionTracker(
                 name=f"{language_title} tool execution", code=code, language=language
@@ -107,32 +525,44 @@ class Tools:
             await emitter.clear_status()
             await emitter.code_execution(execution_tracker)
 
+            # The child runs with this private directory as its working directory so
+            # files it writes are cleaned up with the run. This is not isolation:
+            # absolute paths still reach the host filesystem. Confining it further
+            # would take a chroot or mount namespace (e.g. `unshare --mount`).
             with tempfile.TemporaryDirectory(prefix="code_exec_") as tmp_dir:
-                interpreter_path = None
-                if language == "bash":
-                    interpreter_path = "/bin/bash"
-                elif language == "python":
-                    interpreter_path = sys.executable
+                interpreter_path = _INTERPRETERS.get(language)
                 if not interpreter_path:
                     raise RuntimeError(
                         f"Cannot find interpreter for language: {language}"
                     )
+
+                async def _on_stdout(data):
+                    execution_tracker.set_output(data.decode(errors="replace"))
+                    await emitter.code_execution(execution_tracker)
+
                 try:
-                  result = subprocess.run(
-                      [interpreter_path, "/dev/stdin"],
-                      input=code + "\n",
-                      text=True,
-                      capture_output=True,
-                      timeout=valves.MAX_RUNTIME_SECONDS,
-                      check=False,
-                  )
-                  if result.returncode != 0:
-                      status = "ERROR"
-                      output = result.stderr
-                  else:
-                    status = "OK"
-                    output = result.stdout
-                except subprocess.TimeoutExpired as e:
+                    python_workers = await self._get_python_workers()
+                    if language == "python" and python_workers is not None:
+                        returncode, stdout, stderr = await python_workers.run(
+                            code, cwd=tmp_dir, timeout=valves.MAX_RUNTIME_SECONDS
+                        )
+                    else:
+                        returncode, stdout, stderr = await _run_interpreter(
+                            interpreter_path,
+                            code,
+                            cwd=tmp_dir,
+                            valves=valves,
+                            on_stdout=_on_stdout,
+                        )
+                    if returncode != 0:
+                        status = "ERROR"
+                        output = stderr.decode(errors="replace")
+                    else:
+                        status = "OK"
+                        output = stdout.decode(errors="replace")
+                except _NoPythonWorkerAvailable as e:
+                    return await _fail(str(e))
+                except asyncio.TimeoutError as e:
                     await emitter.fail(
                         f"Code timed out after {valves.MAX_RUNTIME_SECONDS} seconds"
                     )
@@ -140,7 +570,13 @@ class Tools:
                         f"Code timed out after {valves.MAX_RUNTIME_SECONDS} seconds"
                     )
                     status = "TIMEOUT"
-                    output = e.stderr
+                    # Keep the stdout already streamed to the citation as well
+                    # as any error output, rather than blanking it.
+                    output = "\n".join(
+                        part.decode(errors="replace").strip()
+                        for part in (e.stdout, e.stderr)
+                        if part.strip()
+                    )
                 if output:
                     output = output.strip()
                 execution_tracker.set_output(output)
@@ -151,31 +587,27 @@ class Tools:
                         done=True,
                         description=f"[DEBUG MODE] status={status}; output={output}; valves=[{valves}]",
                     )
+                fields = {
+                    "language": language,
+                    "language_title": language_title,
+                    "code": code,
+                    "output": output,
+                    "timeout": valves.MAX_RUNTIME_SECONDS,
+                }
                 if status == "OK":
-                    await emitter.message(
-                        f"\n<details>\n<summary>Code Execution</summary>\nI executed the following {language} code:\n```{language}\n{code}\n```\n```Output\n{output.strip()}\n```\n</details>\n"
-                    )
+                    await emitter.message(_OK_TPL.format_map(fields))
                 elif status == "TIMEOUT":
                     if output:
-                        await emitter.message(
-                            f"\n\n---\nI executed this {language_title} code and it timed out after {valves.MAX_RUNTIME_SECONDS} seconds:\n```Error\n{output}\n```\n"
-                        )
+                        await emitter.message(_TIMEOUT_OUTPUT_TPL.format_map(fields))
                     else:
-                        await emitter.message(
-                            f"\n\n---\nI executed this {language_title} code and it timed out after {valves.MAX_RUNTIME_SECONDS} seconds.\n"
-                        )
+                        await emitter.message(_TIMEOUT_TPL.format_map(fields))
                 elif status == "ERROR" and output:
-                    await emitter.message(
-                        f"\n\n---\nI executed this {language_title} code and got the following error:\n```Error\n{output}\n```\n"
-                    )
+                    await emitter.message(_ERROR_OUTPUT_TPL.format_map(fields))
                 elif status == "ERROR":
-                    await emitter.message(
-                        f"\n\n---\nI executed this {language_title} code but got an unexplained error.\n"
-                    )
+                    await emitter.message(_ERROR_TPL.format_map(fields))
                 else:
                   raise RuntimeError(f"Unexplained status: {status} (output: {output})")
 
-                await emitter.code_execution(execution_tracker)
                 return {
                     "status": status,
                     "output": output,
@@ -184,6 +616,14 @@ class Tools:
             return await _fail(f"Unhandled exception: {e}")
 
 
+class EmitMode(enum.Enum):
+    ONCE = "once"
+    # Some front-ends drop the first event of a kind, so it is sent again on
+    # the next loop iteration without holding up the caller. The copy is
+    # always delivered before the emitter's next event.
+    DEFERRED_SECOND = "deferred_second"
+
+
 class EventEmitter:
     def __init__(
         self,
@@ -192,37 +632,53 @@ class EventEmitter:
     ):
         self.event_emitter = event_emitter
         self._debug = debug
+        self._enabled = bool(event_emitter) or debug
         self._status_prefix = None
         self._emitted_status = False
+        self._duplicate = None
 
     def set_status_prefix(self, status_prefix):
         self._status_prefix = status_prefix
 
-    async def _emit(self, typ, data, twice):
+    async def _emit(self, typ, data, mode):
+        if not self._enabled:
+            return None
+        await self._flush_duplicate()
+        result = await self._send(typ, data)
+        if mode is EmitMode.DEFERRED_SECOND and self.event_emitter:
+            self._duplicate = asyncio.ensure_future(self._send(typ, data))
+        return result
+
+    async def _flush_duplicate(self):
+        # Deliver a still-pending copy of the previous event first so events
+        # keep their order, and so its errors reach a caller.
+        duplicate, self._duplicate = self._duplicate, None
+        if duplicate is not None:
+            await duplicate
+
+    async def _send(self, typ, data):
         if self._debug:
             print(f"Emitting {typ} event: {data}", file=sys.stderr)
         if not self.event_emitter:
             return None
-        result = None
-        for _ in range(2 if twice else 1):
-            maybe_future = self.event_emitter(
-                {
-                    "type": typ,
-                    "data": data,
-                }
-            )
-            if asyncio.isfuture(maybe_future) or isinstance(
-                maybe_future, typing.Awaitable
-            ):
-                result = await maybe_future
-        return result
+        maybe_future = self.event_emitter(
+            {
+                "type": typ,
+                "data": data,
+            }
+        )
+        if maybe_future is not None and hasattr(maybe_future, "__await__"):
+            return await maybe_future
+        return None
 
     async def status(
         self, description="Unknown state", status="in_progress", done=False
     ):
+        if not self._enabled:
+            return
         self._emitted_status = True
-        if self._status_prefix:
-            description = f"{self._status_prefix}{description}"
+        if self._status_prefix is not None:
+            description = self._status_prefix + description
         await self._emit(
             "status",
             {
@@ -230,7 +686,11 @@ class EventEmitter:
                 "description": description,
                 "done": done,
             },
-            twice=not done and len(description) <= 1024,
+            mode=(
+                EmitMode.DEFERRED_SECOND
+                if not done and len(description) <= 1024
+                else EmitMode.ONCE
+            ),
         )
 
     async def fail(self, description="Unknown error"):
@@ -247,21 +707,27 @@ class EventEmitter:
                 "description": "",
                 "done": True,
             },
-            twice=True,
+            mode=EmitMode.DEFERRED_SECOND,
         )
 
     async def message(self, content):
+        if not self._enabled:
+            return
         await self._emit(
             "message",
             {
                 "content": content,
             },
-            twice=False,
+            mode=EmitMode.ONCE,
         )
 
     async def code_execution(self, code_execution_tracker):
+        if not self._enabled:
+            return
         await self._emit(
-            "citation", code_execution_tracker._citation_data(), twice=True
+            "citation",
+            code_execution_tracker._citation_data(),
+            mode=EmitMode.ONCE,
         )
 
 
@@ -272,6 +738,13 @@ class CodeExecutionTracker:
         self.code = code
         self.language = language
         self._result = {}
+        self._base = {
+            "type": "code_execution",
+            "id": self._uuid,
+            "name": name,
+            "code": code,
+            "language": language,
+        }
 
     def set_error(self, error):
         self._result["error"] = error
@@ -280,16 +753,9 @@ class CodeExecutionTracker:
         self._result["output"] = output
 
     def _citation_data(self):
-        data = {
-            "type": "code_execution",
-            "id": self._uuid,
-            "name": self.name,
-            "code": self.code,
-            "language": self.language,
-        }
-        if "output" in self._result or "error" in self._result:
-            data["result"] = self._result
-        return data
+        if self._result:
+            return {**self._base, "result": self._result}
+        return self._base
 
 
 # Debug utility: Run code from stdin if running as a normal Python script.
@@ -308,6 +774,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--debug", action="store_true", default=False, help="Enable debug mode."
     )
+    parser.add_argument(
+        "--python-workers",
+        type=int,
+        default=0,
+        help="Run Python code in a pool of this many long-lived workers.",
+    )
 
     args = parser.parse_args()
 
@@ -317,6 +789,7 @@ if __name__ == "__main__":
             print(f"Event: {event}", file=sys.stderr)
 
         tools = Tools()
+        tools.valves.PYTHON_WORKERS = args.python_workers
         code = sys.stdin.read()
         if args.language == "bash":
             output_str = await tools.run_bash_command(
@@ -328,4 +801,16 @@ if __name__ == "__main__":
             )
         print(output_str)
 
-    asyncio.run(_local_run())
+    # Most awaits here (emitter events, status updates) complete without
+    # suspending, so eager task execution skips a trip through the scheduler.
+    # When hosted by Open WebUI, the same can be enabled at server startup with
+    # `asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)`
+    # on Python 3.12+.
+    loop = asyncio.new_event_loop()
+    if hasattr(asyncio, "eager_task_factory"):
+        loop.set_task_factory(asyncio.eager_task_factory)
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_local_run())
+    finally:
+        loop.close()